@@ -1,16 +1,24 @@
 import os
+import re
+import zlib
+import json
 import uuid
 import time
-from typing import Dict, Any
+import asyncio
+from typing import Dict, Any, List, Optional
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Query
+import aiofiles
+from cachetools import TTLCache
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, BackgroundTasks, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
-from dotenv import load_dotenv
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.routing import APIRoute
+from fastapi.responses import JSONResponse, StreamingResponse
 
-from backend.config import UPLOAD_DIR
-from backend.rag_pipeline import add_documents, get_qa_chain, reset_scope
-
-load_dotenv()
+from backend.config import UPLOAD_DIR, MAX_REQUEST_BYTES, MAX_UPLOAD_BYTES
+from backend.rag_pipeline import (
+    add_documents, prepare_answer, agenerate_answer, astream_answer, reset_scope,
+)
 
 ALLOWED_EXTENSIONS = {".txt", ".pdf", ".docx"}
 
@@ -26,7 +34,81 @@ def is_mime_allowed(ext: str, mime_type: str) -> bool:
         return ("word" in mime) or ("officedocument" in mime) or ("openxmlformats" in mime)
     return False
 
+# In-process indexing jobs for background uploads: job_id -> status dict (expired jobs 404 on /status)
+JOBS: TTLCache = TTLCache(maxsize=1024, ttl=3600)
+
+def _run_index_job(job_id: str, file_path: str, scope: str, fresh: bool):
+    # Hold the dict itself: the cache entry may be evicted while the job runs
+    job = JOBS[job_id]
+    job["status"] = "running"
+    try:
+        if fresh:
+            reset_scope(scope)
+        job.update(status="done", result=add_documents(file_path, scope=scope))
+    except Exception as e:
+        job.update(status="error", detail=str(e))
+
+# Idempotency-Key -> upload response; None while the first request is still running
+IDEMPOTENT: TTLCache = TTLCache(maxsize=1024, ttl=3600)
+
+async def _idempotent(key: Optional[str], run):
+    """
+    Replay the stored response for a repeated Idempotency-Key instead of re-indexing.
+    Only successful responses are remembered, so a failed upload can be retried.
+    """
+    if not key:
+        return await run()
+    if key in IDEMPOTENT:
+        if IDEMPOTENT[key] is None:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is already in progress.")
+        return IDEMPOTENT[key]
+    IDEMPOTENT[key] = None
+    try:
+        result = await run()
+    except BaseException:
+        IDEMPOTENT.pop(key, None)
+        raise
+    IDEMPOTENT[key] = result
+    return result
+
+def _gunzip(body: bytes) -> bytes:
+    """Gunzip an untrusted body, refusing output past MAX_REQUEST_BYTES (decompression bombs)."""
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        out = d.decompress(body, MAX_REQUEST_BYTES + 1)
+    except zlib.error:
+        raise HTTPException(status_code=400, detail="Malformed gzip request body.")
+    if len(out) > MAX_REQUEST_BYTES:
+        raise HTTPException(status_code=413, detail=f"Decompressed body exceeds {MAX_REQUEST_BYTES} bytes.")
+    if not d.eof:
+        raise HTTPException(status_code=400, detail="Truncated gzip request body.")
+    return out
+
+class GzipRequest(Request):
+    """Request whose body is transparently gunzipped when sent with Content-Encoding: gzip."""
+
+    async def body(self) -> bytes:
+        if not hasattr(self, "_body"):
+            body = await super().body()
+            if "gzip" in self.headers.get("content-encoding", "").lower():
+                body = _gunzip(body)
+            self._body = body
+        return self._body
+
+class GzipRoute(APIRoute):
+    def get_route_handler(self):
+        original_handler = super().get_route_handler()
+
+        async def handler(request: Request):
+            return await original_handler(GzipRequest(request.scope, request.receive))
+
+        return handler
+
 app = FastAPI(title="Mini RAG (Embedded Qdrant + Reranker + Groq)")
+app.router.route_class = GzipRoute
+
+# Compress larger JSON responses; Starlette leaves text/event-stream uncompressed
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 app.add_middleware(
     CORSMiddleware,
@@ -40,12 +122,30 @@ app.add_middleware(
 async def root():
     return {"status": "ok", "message": "Mini RAG backend running"}
 
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...), scope: str = Query("default"), fresh: bool = Query(False)):
+async def upload_file(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    scope: str = Query("default"),
+    fresh: bool = Query(False),
+    background: bool = Query(False),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
     """
     Upload .txt/.pdf/.docx and index into embedded Qdrant under 'scope'.
     Set fresh=true to clear previous vectors in this scope.
+    Set background=true to get a job_id back immediately and poll /status/{job_id}.
+    A repeated Idempotency-Key header returns the first response without re-indexing.
     """
+    return await _idempotent(
+        idempotency_key, lambda: _index_upload(background_tasks, file, scope, fresh, background)
+    )
+
+async def _index_upload(background_tasks: BackgroundTasks, file: UploadFile, scope: str, fresh: bool, background: bool):
     ext = os.path.splitext(file.filename or "")[-1].lower()
     mime_type = (file.content_type or "").lower()
 
@@ -59,25 +159,130 @@ async def upload_file(file: UploadFile = File(...), scope: str = Query("default"
     file_path = os.path.join(UPLOAD_DIR, safe_filename)
 
     try:
-        with open(file_path, "wb") as f:
-            while True:
-                chunk = await file.read(1024 * 1024)
-                if not chunk:
-                    break
-                f.write(chunk)
+        async with aiofiles.open(file_path, "wb") as f:
+            while chunk := await file.read(1024 * 1024):
+                await f.write(chunk)
     finally:
         await file.close()
 
+    if background:
+        job_id = uuid.uuid4().hex
+        JOBS[job_id] = {"status": "queued", "file": os.path.basename(file_path), "scope": scope}
+        background_tasks.add_task(_run_index_job, job_id, file_path, scope, fresh)
+        return JSONResponse(status_code=202, content={"job_id": job_id, "status": "queued"})
+
     if fresh:
-        reset_scope(scope)
+        await asyncio.to_thread(reset_scope, scope)
+
+    return await asyncio.to_thread(add_documents, file_path, scope)  # [1][6]
+
+@app.get("/status/{job_id}")
+async def job_status(job_id: str):
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job_id.")
+    return {"job_id": job_id, **job}
+
+# Upload keys handed out by /upload_url that are waiting for their PUT
+PENDING_OBJECTS: TTLCache = TTLCache(maxsize=1024, ttl=900)
+# Keys whose PUT finished writing; only these can be indexed
+UPLOADED_OBJECTS: TTLCache = TTLCache(maxsize=1024, ttl=3600)
+
+_UNSAFE_KEY_RE = re.compile(r"[^A-Za-z0-9_\-]+")
+
+@app.post("/upload_url")
+async def upload_url(body: Dict[str, Any]):
+    """
+    Reserve an upload slot; accepts { "name": "report.pdf", "size": <bytes> }.
+    Returns { "url": "/objects/<key>", "key": "<key>" }: PUT the raw file bytes to url,
+    then POST { "key": ..., "scope": ..., "fresh": bool } to /index.
+    """
+    name = os.path.basename((body or {}).get("name") or "")
+    ext = os.path.splitext(name)[-1].lower()
+    if ext not in ALLOWED_EXTENSIONS:
+        raise HTTPException(status_code=400, detail="Only .txt, .pdf, and .docx files are supported.")
+    size = (body or {}).get("size")
+    if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        raise HTTPException(status_code=400, detail="'size' must be the file size in bytes.")
+    if size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"File exceeds {MAX_UPLOAD_BYTES} bytes.")
+
+    # Key is URL-path safe as-is; the stem is kept only so citations stay readable
+    stem = _UNSAFE_KEY_RE.sub("_", os.path.splitext(name)[0]).strip("_")[:64] or "upload"
+    key = f"{stem}_{uuid.uuid4().hex}{ext}"
+    PENDING_OBJECTS[key] = {"name": name, "size": size}
+    return {"url": f"/objects/{key}", "key": key}
+
+@app.put("/objects/{key}")
+async def put_object(key: str, request: Request):
+    """
+    Stream the raw request body straight to disk (no multipart parsing), up to the size
+    declared in /upload_url. The file only appears under its key once fully written.
+    """
+    slot = PENDING_OBJECTS.pop(key, None)
+    if slot is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired upload key.")
+
+    file_path = os.path.join(UPLOAD_DIR, key)
+    part_path = f"{file_path}.part"
+    written = 0
+    try:
+        async with aiofiles.open(part_path, "wb") as f:
+            async for chunk in request.stream():
+                written += len(chunk)
+                if written > slot["size"]:
+                    break
+                await f.write(chunk)
+        if written > slot["size"]:
+            raise HTTPException(status_code=413, detail=f"Body exceeds the declared size of {slot['size']} bytes.")
+        os.replace(part_path, file_path)
+    except BaseException as e:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        if not isinstance(e, HTTPException):
+            PENDING_OBJECTS[key] = slot  # let the client retry the PUT
+        raise
+    UPLOADED_OBJECTS[key] = slot
+    return {"key": key}
+
+@app.post("/index")
+async def index_object(body: Dict[str, Any]):
+    """
+    Index a file previously PUT to /objects/{key}; accepts { "key": "...", "scope": "...", "fresh": bool }.
+    Each upload can be indexed once.
+    """
+    key = (body or {}).get("key") or ""
+    scope = (body or {}).get("scope", "default")
+    fresh = bool((body or {}).get("fresh", False))
 
-    return add_documents(file_path, scope=scope)  # [1][6]
+    # Claim the key up front so concurrent /index calls can't index it twice
+    slot = UPLOADED_OBJECTS.pop(key, None)
+    if slot is None:
+        raise HTTPException(status_code=404, detail="No completed upload for this key.")
+
+    try:
+        if fresh:
+            await asyncio.to_thread(reset_scope, scope)
+        return await asyncio.to_thread(add_documents, os.path.join(UPLOAD_DIR, key), scope)
+    except ValueError as e:
+        # Unindexable content won't improve on retry; leave the key consumed
+        raise HTTPException(status_code=400, detail=str(e))
+    except BaseException:
+        UPLOADED_OBJECTS[key] = slot  # transient failure: allow a retry
+        raise
 
 @app.post("/upload_text")
-async def upload_text(body: Dict[str, Any]):
+async def upload_text(
+    body: Dict[str, Any],
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
     """
     Index pasted text directly; accepts { "text": "...", "scope": "..." , "fresh": bool }.
+    A repeated Idempotency-Key header returns the first response without re-indexing.
     """
+    return await _idempotent(idempotency_key, lambda: _index_text(body))
+
+async def _index_text(body: Dict[str, Any]):
     text = (body or {}).get("text", "")
     scope = (body or {}).get("scope", "default")
     fresh = bool((body or {}).get("fresh", False))
@@ -86,61 +291,104 @@ async def upload_text(body: Dict[str, Any]):
         raise HTTPException(status_code=400, detail="Text is required.")
 
     if fresh:
-        reset_scope(scope)
+        await asyncio.to_thread(reset_scope, scope)
 
     filename = f"pasted_{uuid.uuid4().hex[:8]}.txt"
     path = os.path.join(UPLOAD_DIR, filename)
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(text)
+    async with aiofiles.open(path, "w", encoding="utf-8") as f:
+        await f.write(text)
 
-    return add_documents(path, scope=scope)
+    return await asyncio.to_thread(add_documents, path, scope)
+
+def _groq_error_detail(e: Exception) -> Optional[str]:
+    msg = str(e)
+    if "decommissioned" in msg or ("model" in msg and "supported" in msg):
+        return "Groq model deprecated/unsupported. Update GROQ_MODEL_ID."
+    if "Invalid API Key" in msg or "401" in msg:
+        return "Groq authentication failed: check GROQ_API_KEY."
+    return None
+
+def _citations(docs) -> List[Dict[str, Any]]:
+    citations = []
+    for idx, d in enumerate(docs, start=1):
+        snippet = (d.page_content or "")[:400]
+        meta = d.metadata or {}
+        citations.append({
+            "marker": f"[{idx}]",
+            "source": meta.get("source", "Unknown"),
+            "section": meta.get("section"),
+            "chunk_id": meta.get("chunk_id"),
+            "position": meta.get("position"),
+            "snippet": snippet
+        })
+    return citations
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
 @app.post("/query")
-async def query_rag(body: Dict[str, Any]):
+async def query_rag(body: Dict[str, Any], request: Request):
     """
-    Query RAG with reranking; accepts { "question": "...", "scope": "..." }.
+    Query RAG with reranking; accepts { "question": "...", "scope": "...", "stream": bool }.
     Returns answer, inline citations mapping, and rough timing.
+    With stream=true (or Accept: text/event-stream) the answer is sent as SSE
+    'token' events followed by one 'citations' event carrying citations + metrics.
     """
     question = (body or {}).get("question")
     scope = (body or {}).get("scope", "default")
+    stream = bool((body or {}).get("stream")) or "text/event-stream" in request.headers.get("accept", "")
 
     if not question:
         raise HTTPException(status_code=400, detail="Question is required.")
 
+    if stream:
+        return await _stream_query(question, scope)
+
+    t0 = time.time()
     try:
-        qa = get_qa_chain(scope=scope)
+        # Embed/search/rerank are CPU-bound: keep them off the event loop.
+        prep = await asyncio.to_thread(prepare_answer, question, scope)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-    t0 = time.time()
+    # Hand the reranked docs to Groq right away and build citations while it runs;
+    # the sleep(0) yields once so the task gets its request onto the wire first.
+    llm_task = asyncio.create_task(agenerate_answer(question, prep))
+    await asyncio.sleep(0)
+    citations = _citations(prep["source_documents"])
     try:
-        out = qa.invoke({"query": question})
+        answer = await llm_task
     except Exception as e:
-        msg = str(e)
-        if "decommissioned" in msg or ("model" in msg and "supported" in msg):
-            raise HTTPException(status_code=400, detail="Groq model deprecated/unsupported. Update GROQ_MODEL_ID.")
-        if "Invalid API Key" in msg or "401" in msg:
-            raise HTTPException(status_code=400, detail="Groq authentication failed: check GROQ_API_KEY.")
+        detail = _groq_error_detail(e)
+        if detail:
+            raise HTTPException(status_code=400, detail=detail)
         raise
 
     latency_ms = int((time.time() - t0) * 1000)
 
-    docs = out.get("source_documents", []) or []
-    citations = []
-    for idx, d in enumerate(docs, start=1):
-        snippet = (d.page_content or "")[:400]
-        meta = d.metadata or {}
-        citations.append({
-            "marker": f"[{idx}]",
-            "source": meta.get("source", "Unknown"),
-            "section": meta.get("section"),
-            "chunk_id": meta.get("chunk_id"),
-            "position": meta.get("position"),
-            "snippet": snippet
-        })
-
     return {
-        "answer": out.get("result", ""),
+        "answer": answer,
         "citations": citations,
-        "metrics": {"latency_ms": latency_ms}
+        "metrics": {"latency_ms": latency_ms, "cached": prep["hit"] is not None}
     }
+
+async def _stream_query(question: str, scope: str) -> StreamingResponse:
+    t0 = time.time()
+    try:
+        prep = await asyncio.to_thread(prepare_answer, question, scope)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def gen():
+        try:
+            async for token in astream_answer(question, prep):
+                yield _sse("token", token)
+        except Exception as e:
+            yield _sse("error", {"detail": _groq_error_detail(e) or str(e)})
+            return
+        yield _sse("citations", {
+            "citations": _citations(prep["source_documents"]),
+            "metrics": {"latency_ms": int((time.time() - t0) * 1000), "cached": prep["hit"] is not None},
+        })
+
+    return StreamingResponse(gen(), media_type="text/event-stream")
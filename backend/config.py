@@ -7,19 +7,41 @@ load_dotenv()
 QDRANT_LOCAL_PATH = os.getenv("QDRANT_LOCAL_PATH", "data/qdrant_local")
 QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION", "mini_rag")
 QDRANT_DISTANCE = os.getenv("QDRANT_DISTANCE", "cosine")  # cosine | dot | euclid
+QDRANT_QUANTIZATION = os.getenv("QDRANT_QUANTIZATION", "int8")  # int8 | binary | none
+QDRANT_OVERSAMPLING = float(os.getenv("QDRANT_OVERSAMPLING", "2.0"))  # rescore candidates from originals
+QDRANT_UPSERT_BATCH = int(os.getenv("QDRANT_UPSERT_BATCH", "256"))  # points per upsert call
 
 # Embeddings
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
 EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "384"))  # MiniLM-L6-v2 => 384
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", str(max(1, (os.cpu_count() or 2) // 2))))
+QUERY_EMBED_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", "2048"))
 
 # Chunking strategy
-CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1000"))
-CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "120"))  # ~12%
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "254"))  # MiniLM-L6-v2 max_seq_length 256 minus [CLS]/[SEP]
+CHUNK_TOKEN_OVERLAP = int(os.getenv("CHUNK_TOKEN_OVERLAP", "32"))  # ~12%
+DEDUP_MAX_HAMMING = int(os.getenv("DEDUP_MAX_HAMMING", "3"))  # SimHash bits; -1 disables dedup
 
 # Retrieval + Reranker
 RETRIEVE_K = int(os.getenv("RETRIEVE_K", "12"))
 RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "4"))
 RERANKER_MODEL = os.getenv("RERANKER_MODEL", "BAAI/bge-reranker-base")
+RERANKER_BACKEND = os.getenv("RERANKER_BACKEND", "torch")  # torch | onnx
+RERANKER_ONNX_FILE = os.getenv("RERANKER_ONNX_FILE", "")  # e.g. onnx/model_qint8_avx512_vnni.onnx
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", "256"))  # tokens per (query, chunk) pair
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "32"))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "10000"))
+RERANK_CACHE_TTL = int(os.getenv("RERANK_CACHE_TTL", "900"))  # seconds
+
+# Semantic answer cache (second Qdrant collection)
+QA_CACHE_COLLECTION = os.getenv("QA_CACHE_COLLECTION", "qa_cache")
+QA_CACHE_THRESHOLD = float(os.getenv("QA_CACHE_THRESHOLD", "0.97"))  # cosine similarity
+QA_CACHE_TTL = int(os.getenv("QA_CACHE_TTL", "3600"))  # seconds; 0 disables the cache
+
+# Request limits
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(8 * 1024 * 1024)))  # gunzipped JSON body cap
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))  # per file on /upload_url + PUT
 
 # LLM (Groq)
 GROQ_API_KEY = os.getenv("GROQ_API_KEY", "")
@@ -1,35 +1,88 @@
 import os
+import re
+import time
+import asyncio
 import uuid
-from typing import List, Dict, Any, Optional
+import hashlib
+import functools
+import threading
+from typing import List, Dict, Any, Optional, Sequence, Tuple, AsyncIterator
+
+import torch
+from cachetools import LRUCache, TTLCache
 
-from dotenv import load_dotenv
 from qdrant_client import QdrantClient, models as qmodels
-from langchain_qdrant import QdrantVectorStore
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.document_loaders import TextLoader, PyPDFLoader
 import docx2txt
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.retrievers import ContextualCompressionRetriever
+from transformers import AutoTokenizer
 from langchain.retrievers.document_compressors import CrossEncoderReranker
 from langchain_community.cross_encoders import HuggingFaceCrossEncoder
-from langchain.chains.retrieval_qa.base import RetrievalQA
+from langchain_core.documents import Document
 from langchain_groq import ChatGroq
 
 from backend.config import (
     QDRANT_LOCAL_PATH, QDRANT_COLLECTION, QDRANT_DISTANCE,
-    EMBEDDING_MODEL, EMBEDDING_DIM, CHUNK_SIZE, CHUNK_OVERLAP,
+    QDRANT_QUANTIZATION, QDRANT_OVERSAMPLING, QDRANT_UPSERT_BATCH,
+    EMBEDDING_MODEL, EMBEDDING_DIM, EMBEDDING_BATCH_SIZE, TORCH_NUM_THREADS,
+    QUERY_EMBED_CACHE_SIZE, CHUNK_TOKENS, CHUNK_TOKEN_OVERLAP, DEDUP_MAX_HAMMING,
     RETRIEVE_K, RERANK_TOP_N, RERANKER_MODEL,
+    RERANKER_BACKEND, RERANKER_ONNX_FILE, RERANK_MAX_LENGTH, RERANK_BATCH_SIZE,
+    RERANK_CACHE_SIZE, RERANK_CACHE_TTL,
+    QA_CACHE_COLLECTION, QA_CACHE_THRESHOLD, QA_CACHE_TTL,
     GROQ_API_KEY, GROQ_MODEL_ID,
 )
+from backend.utils import simhash64
+
+# Torch CPU kernels (MKL-DNN) and intra-op threads, set before any model loads
+torch.set_num_threads(TORCH_NUM_THREADS)
+torch.backends.mkldnn.enabled = True
 
-load_dotenv()
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+# Embeddings (warmed at import so the first request doesn't pay the cold start)
+embeddings = HuggingFaceEmbeddings(
+    model_name=EMBEDDING_MODEL,
+    model_kwargs={"device": DEVICE},
+    encode_kwargs={"batch_size": EMBEDDING_BATCH_SIZE, "normalize_embeddings": True},
+)
+embeddings.embed_query("warmup")
 
-# Embeddings
-embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+# Query embeddings keyed by normalized question text
+_query_embed_cache: LRUCache = LRUCache(maxsize=QUERY_EMBED_CACHE_SIZE)
+_query_embed_lock = threading.Lock()
+
+def embed_query_cached(question: str) -> List[float]:
+    key = " ".join(question.lower().split())
+    with _query_embed_lock:
+        vec = _query_embed_cache.get(key)
+    if vec is None:
+        vec = embeddings.embed_query(question)
+        with _query_embed_lock:
+            _query_embed_cache[key] = vec
+    return vec
 
 # Embedded Qdrant (local, no Docker needed)
 qclient = QdrantClient(path=QDRANT_LOCAL_PATH)
 
+def _quantization_config():
+    """
+    Quantized vectors stay in RAM for HNSW traversal; FP32 originals live on disk
+    for rescoring. Binary quantization only makes sense for cosine/dot.
+    Embedded (path=) Qdrant brute-forces full vectors and ignores this config;
+    it takes effect against a Qdrant server.
+    """
+    mode = QDRANT_QUANTIZATION.lower()
+    if mode == "int8":
+        return qmodels.ScalarQuantization(
+            scalar=qmodels.ScalarQuantizationConfig(type=qmodels.ScalarType.INT8, always_ram=True)
+        )
+    if mode == "binary" and QDRANT_DISTANCE.lower() in ("cosine", "dot"):
+        return qmodels.BinaryQuantization(
+            binary=qmodels.BinaryQuantizationConfig(always_ram=True)
+        )
+    return None
+
 def _ensure_collection():
     metric = {
         "cosine": qmodels.Distance.COSINE,
@@ -38,23 +91,196 @@ def _ensure_collection():
     }.get(QDRANT_DISTANCE.lower(), qmodels.Distance.COSINE)
     existing = [c.name for c in qclient.get_collections().collections]
     if QDRANT_COLLECTION not in existing:
+        quantization = _quantization_config()
         qclient.create_collection(
             collection_name=QDRANT_COLLECTION,
-            vectors_config=qmodels.VectorParams(size=EMBEDDING_DIM, distance=metric),
+            vectors_config=qmodels.VectorParams(
+                size=EMBEDDING_DIM, distance=metric, on_disk=quantization is not None
+            ),
+            quantization_config=quantization,
         )
 
 _ensure_collection()
 
-vectorstore = QdrantVectorStore(
-    client=qclient,
-    collection_name=QDRANT_COLLECTION,
-    embedding=embeddings,
-)
+def _ensure_scope_index():
+    """
+    Keyword payload index on metadata.scope so scoped filters use the inverted
+    index instead of scanning every payload. Embedded (path=) Qdrant ignores payload
+    indexes; this only pays off once QdrantClient points at a Qdrant server.
+    """
+    qclient.create_payload_index(
+        collection_name=QDRANT_COLLECTION,
+        field_name="metadata.scope",
+        field_schema=qmodels.PayloadSchemaType.KEYWORD,
+    )
 
-# Explicit chunking strategy
-splitter = RecursiveCharacterTextSplitter(
-    chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, separators=["\n\n", "\n", " ", ""]
-)
+_ensure_scope_index()
+
+def _backfill_scope():
+    """
+    Points indexed before metadata.scope existed only carry it as the chunk_id
+    prefix ("<scope>:<file>:<i>"); copy it into metadata.scope so scoped search
+    and reset_scope still see them.
+    """
+    missing = qmodels.Filter(must=[qmodels.IsEmptyCondition(is_empty=qmodels.PayloadField(key="metadata.scope"))])
+    offset = None
+    while True:
+        points, offset = qclient.scroll(
+            collection_name=QDRANT_COLLECTION, scroll_filter=missing, limit=1024,
+            offset=offset, with_payload=["metadata"], with_vectors=False,
+        )
+        by_scope: Dict[str, List] = {}
+        for p in points:
+            chunk_id = ((p.payload or {}).get("metadata") or {}).get("chunk_id") or ""
+            if ":" in chunk_id:
+                by_scope.setdefault(chunk_id.split(":", 1)[0], []).append(p.id)
+        for scope, ids in by_scope.items():
+            qclient.set_payload(
+                collection_name=QDRANT_COLLECTION, payload={"scope": scope}, points=ids, key="metadata"
+            )
+        if offset is None:
+            break
+
+_backfill_scope()
+
+def _scope_filter(scope: str) -> qmodels.Filter:
+    return qmodels.Filter(
+        must=[qmodels.FieldCondition(
+            key="metadata.scope",
+            match=qmodels.MatchValue(value=scope)
+        )]
+    )
+
+# Explicit chunking strategy: token windows from the embedding model's fast (Rust) tokenizer
+tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL, use_fast=True)
+# The encoder's max_seq_length counts [CLS]/[SEP], so windows must leave room for both
+CHUNK_WINDOW = min(CHUNK_TOKENS, embeddings.client.max_seq_length - 2)
+
+def _split_documents(docs: List[Document]) -> List[Document]:
+    """
+    Split each document into CHUNK_WINDOW-token windows with CHUNK_TOKEN_OVERLAP overlap,
+    using one tokenizer pass per document. Offsets map windows back onto the original
+    text, so chunks keep their casing/spacing and align with the embedding window.
+    """
+    step = max(1, CHUNK_WINDOW - CHUNK_TOKEN_OVERLAP)
+    chunks: List[Document] = []
+    for doc in docs:
+        text = doc.page_content or ""
+        offsets = tokenizer(
+            text, add_special_tokens=False, return_offsets_mapping=True, verbose=False
+        )["offset_mapping"]
+        for start in range(0, len(offsets), step):
+            window = offsets[start:start + CHUNK_WINDOW]
+            piece = text[window[0][0]:window[-1][1]].strip()
+            if piece:
+                chunks.append(Document(page_content=piece, metadata=dict(doc.metadata)))
+            if start + CHUNK_WINDOW >= len(offsets):
+                break
+    return chunks
+
+def _ensure_qa_cache():
+    existing = [c.name for c in qclient.get_collections().collections]
+    if QA_CACHE_COLLECTION not in existing:
+        qclient.create_collection(
+            collection_name=QA_CACHE_COLLECTION,
+            vectors_config=qmodels.VectorParams(size=EMBEDDING_DIM, distance=qmodels.Distance.COSINE),
+        )
+    qclient.create_payload_index(
+        collection_name=QA_CACHE_COLLECTION,
+        field_name="scope",
+        field_schema=qmodels.PayloadSchemaType.KEYWORD,
+    )
+    qclient.create_payload_index(
+        collection_name=QA_CACHE_COLLECTION,
+        field_name="ts",
+        field_schema=qmodels.PayloadSchemaType.FLOAT,
+    )
+
+_ensure_qa_cache()
+
+# Expired answers are pruned at most this often instead of on every store
+_QA_CACHE_PRUNE_EVERY = 300  # seconds
+_qa_cache_pruned_at = 0.0
+
+def _qa_cache_filter(scope: str, fresh_after: Optional[float] = None) -> qmodels.Filter:
+    must = [qmodels.FieldCondition(key="scope", match=qmodels.MatchValue(value=scope))]
+    if fresh_after is not None:
+        must.append(qmodels.FieldCondition(key="ts", range=qmodels.Range(gte=fresh_after)))
+    return qmodels.Filter(must=must)
+
+def _qa_cache_lookup(query_vector: List[float], scope: str) -> Optional[Dict[str, Any]]:
+    """
+    Return the cached answer for the nearest earlier question in this scope,
+    if it is within QA_CACHE_THRESHOLD and younger than QA_CACHE_TTL.
+    """
+    if QA_CACHE_TTL <= 0:
+        return None
+    hits = qclient.query_points(
+        collection_name=QA_CACHE_COLLECTION,
+        query=query_vector,
+        query_filter=_qa_cache_filter(scope, fresh_after=time.time() - QA_CACHE_TTL),
+        limit=1,
+        score_threshold=QA_CACHE_THRESHOLD,
+        with_payload=True,
+    ).points
+    if not hits:
+        return None
+    payload = hits[0].payload or {}
+    return {
+        "result": payload.get("answer", ""),
+        "source_documents": [
+            Document(page_content=d.get("page_content", ""), metadata=d.get("metadata") or {})
+            for d in payload.get("sources", [])
+        ],
+        "cached": True,
+    }
+
+def _qa_cache_store(query_vector: List[float], scope: str, answer: str, docs: List[Document]):
+    if QA_CACHE_TTL <= 0:
+        return
+    now = time.time()
+    qclient.upsert(
+        collection_name=QA_CACHE_COLLECTION,
+        points=[qmodels.PointStruct(
+            id=str(uuid.uuid4()),
+            vector=query_vector,
+            payload={
+                "scope": scope,
+                "ts": now,
+                "answer": answer,
+                "sources": [{"page_content": d.page_content, "metadata": d.metadata} for d in docs],
+            },
+        )],
+        wait=False,
+    )
+    # Prune expired entries across all scopes; lookups already skip them via the ts filter
+    global _qa_cache_pruned_at
+    if now - _qa_cache_pruned_at < _QA_CACHE_PRUNE_EVERY:
+        return
+    _qa_cache_pruned_at = now
+    qclient.delete(
+        collection_name=QA_CACHE_COLLECTION,
+        points_selector=qmodels.FilterSelector(filter=qmodels.Filter(
+            must=[qmodels.FieldCondition(key="ts", range=qmodels.Range(lt=now - QA_CACHE_TTL))]
+        )),
+    )
+
+def invalidate_qa_cache(scope: str):
+    """
+    Drop cached answers for a scope; called whenever its documents change.
+    """
+    qclient.delete(
+        collection_name=QA_CACHE_COLLECTION,
+        points_selector=qmodels.FilterSelector(filter=_qa_cache_filter(scope)),
+    )
+
+def _search_params() -> qmodels.SearchParams:
+    # Quantization rescoring/oversampling is a no-op in embedded mode, like the config above
+    return qmodels.SearchParams(
+        quantization=qmodels.QuantizationSearchParams(
+            rescore=True, oversampling=QDRANT_OVERSAMPLING
+        )
+    )
 
 def _load_document(file_path: str):
     """
@@ -72,7 +298,6 @@ def _load_document(file_path: str):
         docs = loader.load()
     elif ext == ".docx":
         text = docx2txt.process(file_path)
-        from langchain.schema import Document
         docs = [Document(page_content=text, metadata={"source": file_path})]
     else:
         raise ValueError(f"Unsupported file type: {ext}")
@@ -80,84 +305,284 @@ def _load_document(file_path: str):
         d.metadata.setdefault("source", file_path)
     return docs  # [2][4]
 
+def _dedupe_chunks(chunks: List[Document]) -> List[Document]:
+    """
+    Drop chunks whose SimHash is within DEDUP_MAX_HAMMING bits of an already kept
+    chunk (repeated headers/footers, boilerplate pages) before they cost an embedding.
+    """
+    if DEDUP_MAX_HAMMING < 0:
+        return chunks
+    kept: List[Document] = []
+    seen: List[int] = []
+    for d in chunks:
+        h = simhash64(d.page_content)
+        if any((h ^ s).bit_count() <= DEDUP_MAX_HAMMING for s in seen):
+            continue
+        seen.append(h)
+        kept.append(d)
+    return kept
+
 def _upsert_documents(docs, scope: str):
     """
-    Split, annotate metadata, and upsert with valid UUID point IDs.
+    Split, drop near-duplicates, annotate metadata, batch-embed, and upsert with valid UUID point IDs.
     Keep the human-readable chunk_id in metadata for filtering and citations.
     """
-    chunks = splitter.split_documents(docs)
-    ids: List[str] = []
+    chunks = _dedupe_chunks(_split_documents(docs))
+    n = len(chunks)
+    if not n:
+        return 0
+
+    # Single pass with pre-sized lists and locally bound callables.
+    ids: List[str] = [""] * n
+    texts: List[str] = [""] * n
+    payloads: List[Dict[str, Any]] = [{}] * n
+    new_id = uuid.uuid4
+    basename = os.path.basename
+    bases: Dict[str, str] = {}
     for i, d in enumerate(chunks):
-        base = os.path.basename(d.metadata.get("source", "unknown"))
-        chunk_id = f"{scope}:{base}:{i}"
-        d.metadata["chunk_id"] = chunk_id
-        d.metadata.setdefault("section", d.metadata.get("page"))
-        d.metadata["position"] = i
-        ids.append(str(uuid.uuid4()))
-    vectorstore.add_documents(chunks, ids=ids)
-    return len(chunks)
+        meta = d.metadata
+        source = meta.get("source", "unknown")
+        base = bases.get(source)
+        if base is None:
+            base = bases[source] = basename(source)
+        meta.update(
+            chunk_id=f"{scope}:{base}:{i}",
+            scope=scope,
+            section=meta.get("section", meta.get("page")),
+            position=i,
+        )
+        ids[i] = str(new_id())
+        texts[i] = d.page_content
+        payloads[i] = {"page_content": d.page_content, "metadata": meta}
+
+    # Embed all chunks in one batched call, then upsert precomputed vectors
+    # using the page_content/metadata payload layout search_similar reads back.
+    vectors = embeddings.embed_documents(texts)
+    points = [
+        qmodels.PointStruct(id=ids[i], vector=vectors[i], payload=payloads[i])
+        for i in range(n)
+    ]
+    # Fire-and-forget batches; only the last one waits so the call returns durable.
+    for start in range(0, len(points), QDRANT_UPSERT_BATCH):
+        batch = points[start:start + QDRANT_UPSERT_BATCH]
+        last = start + QDRANT_UPSERT_BATCH >= len(points)
+        qclient.upsert(collection_name=QDRANT_COLLECTION, points=batch, wait=last)
+    return n
 
 def reset_scope(scope: str):
     """
-    Delete all points for a given scope by filtering on metadata.chunk_id prefix.
-    Important: use 'metadata.chunk_id' with QdrantVectorStore payload layout.
+    Delete all points for a given scope by filtering on the indexed metadata.scope.
+    Important: use 'metadata.*' keys to match the page_content/metadata payload layout.
     """
-    prefix = f"{scope}:"
     qclient.delete(
         collection_name=QDRANT_COLLECTION,
-        points_selector=qmodels.FilterSelector(
-            filter=qmodels.Filter(
-                must=[qmodels.FieldCondition(
-                    key="metadata.chunk_id",
-                    match=qmodels.MatchText(text=prefix)
-                )]
-            )
-        )
+        points_selector=qmodels.FilterSelector(filter=_scope_filter(scope))
     )  # [3][5]
+    invalidate_qa_cache(scope)
 
 def add_documents(file_path: str, scope: Optional[str] = "default") -> Dict[str, Any]:
     docs = _load_document(file_path)
     if not docs:
         raise ValueError("No text extracted from document.")
     added = _upsert_documents(docs, scope=scope or "default")
+    invalidate_qa_cache(scope or "default")
     return {"message": f"Indexed {added} chunks for {os.path.basename(file_path)} in scope '{scope}'."}
 
-def get_retriever_with_reranker(scope: Optional[str] = "default"):
+# Cross-encoder scores keyed by (query digest, chunk_id); shared across requests
+_rerank_cache: TTLCache = TTLCache(maxsize=RERANK_CACHE_SIZE, ttl=RERANK_CACHE_TTL)
+_rerank_lock = threading.RLock()
+
+# Exact-phrase or bare-filename queries gain nothing from semantic reranking
+_NO_RERANK_RE = re.compile(r'^"[^"]+"$|^[\w\-.]+\.(txt|pdf|docx)$', re.IGNORECASE)
+
+class CachedCrossEncoderReranker(CrossEncoderReranker):
     """
-    Retrieve top-k filtered by scope, then rerank to top_n via a local cross-encoder.
+    CrossEncoderReranker that only forwards uncached (query, chunk) pairs
+    through the model and splices cached scores back in original order.
     """
-    prefix = f"{scope}:"
-    scope_filter = qmodels.Filter(
-        must=[qmodels.FieldCondition(
-            key="metadata.chunk_id",
-            match=qmodels.MatchText(text=prefix)
-        )]
-    )
 
-    base_retriever = vectorstore.as_retriever(
-        search_type="similarity",
-        search_kwargs={"k": RETRIEVE_K, "filter": scope_filter}
+    def compress_documents(self, documents: Sequence[Document], query: str, callbacks=None) -> Sequence[Document]:
+        if not documents:
+            return []
+        if _NO_RERANK_RE.match(query.strip()):
+            return list(documents)[: self.top_n]
+
+        qkey = hashlib.blake2b(query.encode("utf-8"), digest_size=16).digest()
+        keys = [
+            (qkey, d.metadata.get("chunk_id") or hashlib.blake2b(d.page_content.encode("utf-8"), digest_size=16).digest())
+            for d in documents
+        ]
+        scores: List[Optional[float]] = [None] * len(documents)
+        with _rerank_lock:
+            for i, k in enumerate(keys):
+                scores[i] = _rerank_cache.get(k)
+
+        missing = [i for i, sc in enumerate(scores) if sc is None]
+        if missing:
+            fresh = self.model.score([(query, documents[i].page_content) for i in missing])
+            with _rerank_lock:
+                for i, sc in zip(missing, fresh):
+                    scores[i] = float(sc)
+                    _rerank_cache[keys[i]] = scores[i]
+
+        ranked = sorted(zip(documents, scores), key=lambda x: x[1], reverse=True)
+        return [doc for doc, _ in ranked[: self.top_n]]
+
+class BatchedCrossEncoder(HuggingFaceCrossEncoder):
+    """
+    Scores pairs with the underlying tokenizer/model directly: pairs are sorted by
+    length, padded only to the longest pair in each batch, and clipped at
+    RERANK_MAX_LENGTH tokens. Returns raw relevance logits in input order.
+    """
+
+    def score(self, text_pairs: List[Tuple[str, str]]) -> List[float]:
+        if not text_pairs:
+            return []
+        tokenizer = self.client.tokenizer
+        model = self.client.model
+        order = sorted(range(len(text_pairs)), key=lambda i: len(text_pairs[i][1]), reverse=True)
+        scores: List[float] = [0.0] * len(text_pairs)
+        with torch.inference_mode():
+            for start in range(0, len(order), RERANK_BATCH_SIZE):
+                idx = order[start:start + RERANK_BATCH_SIZE]
+                batch = tokenizer(
+                    [text_pairs[i][0] for i in idx],
+                    [text_pairs[i][1] for i in idx],
+                    padding="longest",
+                    truncation=True,
+                    max_length=RERANK_MAX_LENGTH,
+                    return_tensors="pt",
+                ).to(model.device)
+                logits = model(**batch).logits
+                # Single-logit rerankers score directly; two-class heads use the positive class
+                logits = logits[:, 1] if logits.shape[-1] > 1 else logits.squeeze(-1)
+                for i, sc in zip(idx, logits.float().cpu().tolist()):
+                    scores[i] = sc
+        return scores
+
+def _load_cross_encoder() -> HuggingFaceCrossEncoder:
+    """
+    Load the reranker once per process. With RERANKER_BACKEND=onnx the model runs
+    through ONNX Runtime (optionally a pre-quantized int8 file); otherwise torch.
+    """
+    model_kwargs: Dict[str, Any] = {"device": DEVICE}
+    if RERANKER_BACKEND.lower() == "onnx":
+        model_kwargs["backend"] = "onnx"
+        if RERANKER_ONNX_FILE:
+            model_kwargs["model_kwargs"] = {"file_name": RERANKER_ONNX_FILE}
+    ce = BatchedCrossEncoder(
+        model_name=RERANKER_MODEL or "cross-encoder/ms-marco-MiniLM-L-6-v2",
+        model_kwargs=model_kwargs,
     )
+    if hasattr(ce.client, "model") and hasattr(ce.client.model, "eval"):
+        ce.client.model.eval()
+    return ce
 
-    reranker_model = RERANKER_MODEL or "cross-encoder/ms-marco-MiniLM-L-6-v2"
-    ce = HuggingFaceCrossEncoder(model_name=reranker_model)
-    compressor = CrossEncoderReranker(model=ce, top_n=RERANK_TOP_N)
+cross_encoder = _load_cross_encoder()
 
-    return ContextualCompressionRetriever(
-        base_retriever=base_retriever, base_compressor=compressor
-    )  # [3]
+reranker = CachedCrossEncoderReranker(model=cross_encoder, top_n=RERANK_TOP_N)
 
-def get_qa_chain(scope: Optional[str] = "default"):
-    retriever = get_retriever_with_reranker(scope=scope or "default")
+def search_similar(query_vector: List[float], scope: Optional[str] = "default") -> List[Document]:
+    """
+    Top-k scoped similarity search against Qdrant with a precomputed query vector,
+    mapped back to LangChain Documents from the stored payload.
+    """
+    hits = qclient.query_points(
+        collection_name=QDRANT_COLLECTION,
+        query=query_vector,
+        query_filter=_scope_filter(scope or "default"),
+        limit=RETRIEVE_K,
+        search_params=_search_params(),
+        with_payload=True,
+    ).points
+    docs = []
+    for h in hits:
+        payload = h.payload or {}
+        docs.append(Document(
+            page_content=payload.get("page_content", ""),
+            metadata=payload.get("metadata") or {},
+        ))
+    return docs  # [3]
+
+def retrieve(question: str, scope: Optional[str] = "default", query_vector: Optional[List[float]] = None) -> List[Document]:
+    """
+    Embed the question once (unless a vector is passed), search by vector,
+    then rerank to top_n via the cross-encoder.
+    """
+    if query_vector is None:
+        query_vector = embed_query_cached(question)
+    docs = search_similar(query_vector, scope=scope)
+    return list(reranker.compress_documents(docs, question))
+
+@functools.lru_cache(maxsize=4)
+def _get_llm(model_id: str, api_key: str) -> ChatGroq:
+    """
+    One ChatGroq per (model, key) so its HTTP connection pool is reused across queries.
+    """
+    return ChatGroq(model=model_id, groq_api_key=api_key)
+
+SYSTEM_PROMPT = (
+    "Answer the question using only the numbered context passages. "
+    "Cite the passages you rely on inline as [n]. "
+    "If the context does not contain the answer, say you don't know."
+)
+
+def _build_messages(question: str, docs: List[Document]):
+    """
+    Stuff the reranked chunks into one prompt; [n] matches the citation markers /query returns.
+    """
+    context = "\n\n".join(f"[{i}] {d.page_content}" for i, d in enumerate(docs, start=1))
+    return [
+        ("system", SYSTEM_PROMPT),
+        ("human", f"Context:\n{context}\n\nQuestion: {question}"),
+    ]
 
+def prepare_answer(question: str, scope: Optional[str] = "default") -> Dict[str, Any]:
+    """
+    Everything /query needs before the LLM call: the query vector and either a
+    semantic-cache hit ("cached" payload) or the reranked source documents.
+    """
     if not GROQ_API_KEY:
         raise ValueError("GROQ_API_KEY is not set in .env")
 
-    llm = ChatGroq(model=GROQ_MODEL_ID, groq_api_key=GROQ_API_KEY)
+    scope = scope or "default"
+    query_vector = embed_query_cached(question)
+    hit = _qa_cache_lookup(query_vector, scope)
+    if hit is not None:
+        return {"scope": scope, "query_vector": query_vector, "hit": hit, "source_documents": hit["source_documents"]}
+    docs = retrieve(question, scope=scope, query_vector=query_vector)
+    return {"scope": scope, "query_vector": query_vector, "hit": None, "source_documents": docs}
 
-    qa = RetrievalQA.from_chain_type(
-        llm=llm,
-        retriever=retriever,
-        return_source_documents=True
-    )
-    return qa
+async def agenerate_answer(question: str, prep: Dict[str, Any]) -> str:
+    """
+    Async single Groq call over prepared sources (or the cached answer), so the
+    event loop stays free while the completion is in flight.
+    """
+    if prep["hit"] is not None:
+        return prep["hit"]["result"]
+
+    docs = prep["source_documents"]
+    llm = _get_llm(GROQ_MODEL_ID, GROQ_API_KEY)
+
+    resp = await llm.ainvoke(_build_messages(question, docs))
+    await asyncio.to_thread(_qa_cache_store, prep["query_vector"], prep["scope"], resp.content, docs)
+    return resp.content
+
+async def astream_answer(question: str, prep: Dict[str, Any]) -> AsyncIterator[str]:
+    """
+    Yield answer text as Groq streams it (or the cached answer in one piece),
+    storing the full answer in the semantic cache once the stream completes.
+    """
+    if prep["hit"] is not None:
+        yield prep["hit"]["result"]
+        return
+
+    docs = prep["source_documents"]
+    llm = _get_llm(GROQ_MODEL_ID, GROQ_API_KEY)
+
+    parts: List[str] = []
+    async for chunk in llm.astream(_build_messages(question, docs)):
+        if chunk.content:
+            parts.append(chunk.content)
+            yield chunk.content
+    await asyncio.to_thread(_qa_cache_store, prep["query_vector"], prep["scope"], "".join(parts), docs)
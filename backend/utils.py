@@ -1,17 +1,31 @@
 import os
 import re
+import hashlib
+from collections import Counter
 from typing import List
 
+_WS_RE = re.compile(r'\s+')
+
 def clean_text(text: str) -> str:
-    return re.sub(r'\s+', ' ', text).strip()
+    if text.isascii():
+        return " ".join(text.split())
+    return _WS_RE.sub(' ', text).strip()
 
 def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
     words = text.split()
-    chunks = []
-    start = 0
-    while start < len(words):
-        end = start + chunk_size
-        chunk = " ".join(words[start:end])
-        chunks.append(chunk)
-        start += max(1, chunk_size - overlap)
-    return chunks
+    step = max(1, chunk_size - overlap)
+    return [" ".join(words[start:start + chunk_size]) for start in range(0, len(words), step)]
+
+_WORD_RE = re.compile(r'\w+')
+
+def simhash64(text: str) -> int:
+    """
+    64-bit SimHash over lowercased word features, weighted by frequency.
+    Near-duplicate texts differ in only a few bits.
+    """
+    weights = [0] * 64
+    for word, count in Counter(_WORD_RE.findall(text.lower())).items():
+        h = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += count if (h >> bit) & 1 else -count
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
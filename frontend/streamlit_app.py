@@ -1,23 +1,15 @@
 import os
+import gzip
+import hashlib
+import json
 import time
-import requests
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import orjson
+from cachetools import TTLCache
 import streamlit as st
-import streamlit.components.v1 as components
-
-# ----------------------------
-# Auto Scroll Function
-# ----------------------------
-def scroll_to_bottom():
-    components.html(
-        """
-        <script>
-        setTimeout(function() {
-            window.parent.scrollTo(0, window.parent.document.body.scrollHeight);
-        }, 100);
-        </script>
-        """,
-        height=0,
-    )
 
 # ----------------------------
 # App Configuration
@@ -27,18 +19,11 @@ st.set_page_config(page_title="Mini RAG Chat", layout="wide")
 # ----------------------------
 # Custom Styling (compact, dark)
 # ----------------------------
+# Colors/radii live in .streamlit/config.toml [theme]; only layout tweaks the
+# theme can't express remain here.
 THEME_CSS = """
 <style>
-html, body, [data-testid="stAppViewContainer"] { background-color: #0f172a; color: #e2e8f0; }
-[data-testid="stSidebar"] { background-color: #111827; border-right: 1px solid #1f2937; }
 .block-container { padding-top: 0.5rem !important; padding-bottom: 0.5rem !important; }
-.user-msg { background-color: #0369a1; color: #f0f9ff; padding: 0.75rem 1rem; border-radius: 18px 18px 5px 18px; margin: 0.25rem 0 0.5rem auto; max-width: 80%; width: fit-content; }
-.assistant-msg { background-color: #374151; color: #f3f4f6; padding: 0.75rem 1rem; border-radius: 18px 18px 18px 5px; margin: 0.25rem auto 0.5rem 0; max-width: 80%; width: fit-content; }
-.stTextInput > div > div > input, .stTextArea textarea { background-color: #111827 !important; color: #e5e7eb !important; border: 1px solid #334155 !important; border-radius: 10px !important; }
-.stButton > button { background-color: #1f2937 !important; color: #e5e7eb !important; border: 1px solid #334155 !important; border-radius: 20px !important; height: 3rem !important; }
-.stButton > button:hover { border-color: #60a5fa !important; background-color: #374151 !important; }
-.stFileUploader div[data-testid="stFileUploaderDropzone"] { background-color: #111827 !important; border: 2px dashed #334155 !important; border-radius: 10px !important; }
-.source-card { background: #1e293b; border: 1px solid #334155; border-radius: 8px; padding: 0.75rem; margin: 0.5rem 0; }
 div[data-testid="stVerticalBlock"] > div { gap: 0.25rem !important; }
 footer, header { visibility: hidden; }
 </style>
@@ -49,57 +34,288 @@ st.markdown(THEME_CSS, unsafe_allow_html=True)
 # Backend Config & Helper
 # ----------------------------
 BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
+# Fail fast when the backend is down instead of waiting out the OS SYN timeout
+TIMEOUT = httpx.Timeout(60.0, connect=2.0)
+
+@st.cache_resource
+def get_http() -> httpx.Client:
+    """One keep-alive HTTP/2 client per Streamlit process, reused across reruns."""
+    transport = httpx.HTTPTransport(
+        http2=True,
+        retries=2,  # connection failures only, so POSTs are never replayed
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=8, keepalive_expiry=30),
+    )
+    return httpx.Client(base_url=BACKEND_URL, transport=transport, timeout=TIMEOUT)
+
+@st.cache_resource
+def get_executor() -> ThreadPoolExecutor:
+    """Worker threads that consume /query streams off the Streamlit script thread."""
+    return ThreadPoolExecutor(max_workers=4)
+
+@st.cache_data(ttl=10, show_spinner=False)
+def backend_ok() -> bool:
+    try:
+        return get_http().get("/health", timeout=httpx.Timeout(2.0, connect=1.0)).is_success
+    except httpx.TransportError:
+        return False
+
+@st.cache_resource
+def get_answer_cache() -> dict:
+    """Process-wide (scope, question) -> answer cache shared by every session."""
+    return {"lock": threading.Lock(), "entries": TTLCache(maxsize=256, ttl=300)}
+
+def _answer_key(question: str, scope: str):
+    return scope, " ".join(question.lower().split())
+
+def cached_answer(question: str, scope: str):
+    cache = get_answer_cache()
+    with cache["lock"]:
+        return cache["entries"].get(_answer_key(question, scope))
+
+def store_answer(question: str, scope: str, answer: str, sources: list):
+    cache = get_answer_cache()
+    with cache["lock"]:
+        cache["entries"][_answer_key(question, scope)] = {"answer": answer, "sources": sources}
+
+def invalidate_answers(scope: str):
+    """New documents in a scope make its cached answers stale."""
+    cache = get_answer_cache()
+    with cache["lock"]:
+        for key in [k for k in cache["entries"] if k[0] == scope]:
+            del cache["entries"][key]
+
+def idempotency_key(kind: str, scope: str, fingerprint) -> str:
+    """Stable key for re-sends of the same upload; a new input gets a new key."""
+    slot = f"idem_{kind}_{scope}"
+    held = st.session_state.get(slot)
+    if not held or held[0] != fingerprint:
+        held = st.session_state[slot] = (fingerprint, uuid.uuid4().hex)
+    return held[1]
+
+def rotate_idempotency_key(kind: str, scope: str):
+    st.session_state.pop(f"idem_{kind}_{scope}", None)
+
+GZIP_MIN_BYTES = 4096
+
+def json_body(payload) -> dict:
+    """httpx kwargs for a JSON body, gzipped once it is large enough to be worth it."""
+    body = json.dumps(payload).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if len(body) > GZIP_MIN_BYTES:
+        body = gzip.compress(body, compresslevel=3)
+        headers["Content-Encoding"] = "gzip"
+    return {"content": body, "headers": headers}
+
+def file_digest(uploaded_file) -> str:
+    """blake2b of the upload's bytes, computed once per file_id and kept in session state."""
+    digests = st.session_state.setdefault("file_digests", {})
+    if uploaded_file.file_id not in digests:
+        digests[uploaded_file.file_id] = hashlib.blake2b(uploaded_file.getbuffer(), digest_size=16).hexdigest()
+    return digests[uploaded_file.file_id]
 
 def _safe_json(res):
     try:
-        return res.json()
+        # orjson straight from the raw bytes skips the decode to str that res.json() does
+        return orjson.loads(res.content)
     except Exception:
         return None
 
+def _error_detail(res, data) -> str:
+    return (data or {}).get("detail") or (res.text if res is not None else "")
+
+def _unreachable(e: Exception) -> str:
+    return f"Backend unreachable at {BACKEND_URL} ({type(e).__name__})."
+
+def _sse_events(res):
+    """Yield (event, data) pairs from a text/event-stream response."""
+    event = "message"
+    for line in res.iter_lines():
+        if line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            yield event, orjson.loads(line[5:])
+        elif not line:
+            event = "message"
+
+def _run_query_job(client: httpx.Client, req: dict, job: dict):
+    """
+    Worker thread: read the SSE answer into the plain `job` dict that the chat
+    fragment polls. No Streamlit calls happen here.
+    """
+    t0 = time.time()
+    try:
+        with client.stream(
+            "POST", "/query",
+            content=req["content"],
+            headers={**req["headers"], "Accept": "text/event-stream"},
+        ) as res:
+            if res.is_success:
+                # Tokens accumulate as they arrive; citations/errors come in trailing events
+                for event, data in _sse_events(res):
+                    if event == "token":
+                        job["tokens"].append(data)
+                    elif event in ("citations", "error"):
+                        job["trailer"][event] = data
+                if "error" in job["trailer"]:
+                    job["error"] = job["trailer"]["error"].get("detail")
+            else:
+                res.read()
+                job["error"] = _error_detail(res, _safe_json(res))
+    except httpx.TransportError as e:
+        job["error"] = _unreachable(e)
+        job["unreachable"] = True
+    except Exception as e:
+        # Decoding/stream errors or a malformed SSE line must still end the job
+        job["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        job["elapsed"] = int((time.time() - t0) * 1000)
+
 # ----------------------------
 # Initialize Session State
 # ----------------------------
+# Only the newest MESSAGE_WINDOW messages stay in session state and get rendered;
+# older turns are paged out to a per-session archive file on disk.
+MESSAGE_WINDOW = 50
+# App-owned and private: archives are only ever read back by the session that wrote them
+ARCHIVE_DIR = os.getenv("CHAT_ARCHIVE_DIR", "data/chat_archive")
+os.makedirs(ARCHIVE_DIR, mode=0o700, exist_ok=True)
+ARCHIVE_MAX_AGE = 24 * 3600  # seconds since an archive was last written
+
+def _prune_archives():
+    """Delete archives of sessions that have been idle longer than ARCHIVE_MAX_AGE."""
+    cutoff = time.time() - ARCHIVE_MAX_AGE
+    try:
+        entries = list(os.scandir(ARCHIVE_DIR))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if entry.name.endswith(".jsonl") and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass  # another session pruned it first
+
 if "messages" not in st.session_state:
     st.session_state.messages = []
-if "processing" not in st.session_state:
-    st.session_state.processing = False
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+    _prune_archives()
+if "archived_count" not in st.session_state:
+    st.session_state.archived_count = 0
+if "pending" not in st.session_state:
+    st.session_state.pending = None
+if "offline" not in st.session_state:
+    st.session_state.offline = False
+
+def _archive_path() -> str:
+    return os.path.join(ARCHIVE_DIR, f"{st.session_state.session_id}.jsonl")
+
+def _read_archive() -> list:
+    """The archive is JSON lines, one message per line, oldest first."""
+    try:
+        with open(_archive_path(), "rb") as f:
+            return [orjson.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+def _append_archive(messages: list):
+    with open(_archive_path(), "ab") as f:
+        f.writelines(orjson.dumps(m) + b"\n" for m in messages)
+
+def _write_archive(messages: list):
+    with open(_archive_path(), "wb") as f:
+        f.writelines(orjson.dumps(m) + b"\n" for m in messages)
+
+def add_message(message: dict):
+    """Append to the render window, paging the oldest turns out to disk on overflow."""
+    messages = st.session_state.messages
+    messages.append(message)
+    if len(messages) > MESSAGE_WINDOW:
+        overflow = messages[:-MESSAGE_WINDOW]
+        _append_archive(overflow)
+        st.session_state.messages = messages[-MESSAGE_WINDOW:]
+        st.session_state.archived_count += len(overflow)
+
+def load_older():
+    """Move the newest MESSAGE_WINDOW archived turns back in front of the window."""
+    archive = _read_archive()
+    older = archive[-MESSAGE_WINDOW:]
+    _write_archive(archive[:-MESSAGE_WINDOW])
+    st.session_state.messages = older + st.session_state.messages
+    st.session_state.archived_count = len(archive) - len(older)
 
 # ----------------------------
 # Sidebar Controls
 # ----------------------------
-with st.sidebar:
+@st.fragment
+def sidebar_panel():
+    """
+    Settings + uploads; their widgets rerun only this fragment, and chat sends don't
+    re-render the uploader. Settings reach the chat panel through session_state keys.
+    """
     st.markdown("### 🔧 Settings")
-    scope = st.text_input("Session Scope", value="default")
-    fresh = st.checkbox("Fresh scope on upload", value=False)
+    scope = st.text_input("Session Scope", value="default", key="scope")
+    fresh = st.checkbox("Fresh scope on upload", value=False, key="fresh")
+    st.checkbox("Fresh answer (skip cache)", value=False, key="fresh_answer")
     st.markdown("---")
 
     # Upload section
     st.markdown("### 📁 Upload Content")
     uploaded_file = st.file_uploader("Upload document", type=["txt", "pdf", "docx"])
     if uploaded_file and st.button("🔄 Index File", use_container_width=True):
-        files = {"file": (uploaded_file.name, uploaded_file.getvalue(), uploaded_file.type or "application/octet-stream")}
-        params = {"scope": scope, "fresh": str(fresh).lower()}
-        with st.spinner("Indexing..."):
-            t0 = time.time()
-            res = requests.post(f"{BACKEND_URL}/upload", files=files, params=params)
-            data = _safe_json(res)
-        if res.ok and data:
-            st.success(f"✅ Indexed ({int((time.time()-t0)*1000)} ms)")
+        digest = file_digest(uploaded_file)
+        indexed = st.session_state.setdefault(f"indexed_{scope}", set())
+        if digest in indexed and not fresh:
+            st.info("Already indexed in this scope.")
         else:
-            st.error(f"❌ {(data or {}).get('detail', res.text)}")
+            # Clicks during the POST only queue a rerun; the Idempotency-Key is what stops a double index.
+            # Pass the file-like itself so httpx streams it instead of copying the bytes
+            uploaded_file.seek(0)
+            files = {"file": (uploaded_file.name, uploaded_file, uploaded_file.type or "application/octet-stream")}
+            params = {"scope": scope, "fresh": str(fresh).lower()}
+            headers = {"Idempotency-Key": idempotency_key("file", scope, (uploaded_file.file_id, fresh))}
+            try:
+                with st.spinner("Indexing..."):
+                    t0 = time.time()
+                    res = get_http().post("/upload", files=files, params=params, headers=headers)
+                    data = _safe_json(res)
+            except httpx.TransportError as e:
+                res, data = None, {"detail": _unreachable(e)}
+            if res is not None and res.is_success and data:
+                if fresh:
+                    indexed.clear()
+                indexed.add(digest)
+                rotate_idempotency_key("file", scope)
+                invalidate_answers(scope)
+                st.success(f"✅ Indexed ({int((time.time()-t0)*1000)} ms)")
+            else:
+                st.error(f"❌ {_error_detail(res, data)}")
 
     st.markdown("---")
     text = st.text_area("Paste text", height=80, placeholder="Paste content...")
     if st.button("🔄 Index Text", use_container_width=True):
         if text.strip():
-            with st.spinner("Indexing..."):
-                t0 = time.time()
-                res = requests.post(f"{BACKEND_URL}/upload_text", json={"text": text, "scope": scope, "fresh": fresh})
-                data = _safe_json(res)
-            if res.ok and data:
+            headers = {"Idempotency-Key": idempotency_key("text", scope, (hash(text), fresh))}
+            try:
+                with st.spinner("Indexing..."):
+                    t0 = time.time()
+                    req = json_body({"text": text, "scope": scope, "fresh": fresh})
+                    res = get_http().post("/upload_text", content=req["content"], headers={**req["headers"], **headers})
+                    data = _safe_json(res)
+            except httpx.TransportError as e:
+                res, data = None, {"detail": _unreachable(e)}
+            if res is not None and res.is_success and data:
+                if fresh:
+                    st.session_state.pop(f"indexed_{scope}", None)
+                rotate_idempotency_key("text", scope)
+                invalidate_answers(scope)
                 st.success(f"✅ Indexed ({int((time.time()-t0)*1000)} ms)")
             else:
-                st.error(f"❌ {(data or {}).get('detail', res.text)}")
+                st.error(f"❌ {_error_detail(res, data)}")
+
+# st.sidebar can't be called from inside a fragment, so enter it out here
+with st.sidebar:
+    sidebar_panel()
 
 # ----------------------------
 # Main Chat Interface
@@ -107,58 +323,116 @@ with st.sidebar:
 st.title("💬 Mini RAG Chat")
 st.caption("Ask questions about your uploaded documents")
 
-if not st.session_state.messages:
-    st.markdown('<div class="assistant-msg">👋 Hello! Upload documents and ask questions about them.</div>', unsafe_allow_html=True)
-
-for message in st.session_state.messages:
-    role = message["role"]
-    content = message["content"]
-    if role == "user":
-        st.markdown(f'<div class="user-msg">{content}</div>', unsafe_allow_html=True)
-    else:
-        st.markdown(f'<div class="assistant-msg">{content}</div>', unsafe_allow_html=True)
-        if "sources" in message and message["sources"]:
-            with st.expander("📄 Sources", expanded=False):
-                for i, source in enumerate(message["sources"], 1):
-                    st.markdown(f"**{source.get('marker', f'[{i}]')} {source.get('source', 'Unknown')}**")
-                    if source.get('section'):
-                        st.text(f"Section: {source.get('section')}")
-                    st.code(source.get('snippet', ''), language='text')
-
-st.markdown("---")
-
-# Use a form to avoid rerun on every keystroke and prevent loops
-with st.form(key="chat_form", clear_on_submit=True):
-    col1, col2 = st.columns([5, 1])
-    with col1:
-        user_input = st.text_input("Message", placeholder="Ask something about your documents...", label_visibility="collapsed")
-    with col2:
-        send_button = st.form_submit_button("➤", use_container_width=True)
-
-if send_button and user_input.strip() and not st.session_state.processing:
-    st.session_state.processing = True
-    st.session_state.messages.append({"role": "user", "content": user_input})
-
-    with st.spinner("🤔 Thinking..."):
-        t0 = time.time()
-        res = requests.post(f"{BACKEND_URL}/query", json={"question": user_input, "scope": scope})
-        data = _safe_json(res)
-        elapsed = int((time.time() - t0) * 1000)
-
-    if res.ok and data:
-        answer = data.get("answer", "")
-        sources = data.get("citations", [])
+def _finish_pending(pending: dict):
+    job = pending["job"]
+    exc = pending["future"].exception()
+    if exc is not None and job.get("error") is None:
+        job["error"] = f"{type(exc).__name__}: {exc}"
+    if job.get("unreachable"):
+        backend_ok.clear()
+    if job.get("error") is None:
+        answer = "".join(job["tokens"])
         assistant_message = {
             "role": "assistant",
-            "content": f"{answer}\n\n⏱️ {elapsed}ms",
-            "sources": sources
+            "id": uuid.uuid4().hex,
+            "content": f"{answer}\n\n⏱️ {job.get('elapsed', 0)}ms",
+            "sources": job["trailer"].get("citations", {}).get("citations", [])
         }
-        st.session_state.messages.append(assistant_message)
+        add_message(assistant_message)
+        store_answer(pending["question"], pending["scope"], answer, assistant_message["sources"])
     else:
-        st.session_state.messages.append({"role": "assistant", "content": f"❌ Error: {(data or {}).get('detail', res.text)}"})
+        add_message({"role": "assistant", "content": f"❌ Error: {job['error']}"})
+    st.session_state.pending = None
+
+def render_sources(sources: list) -> str:
+    """All citations of one message as a single markdown block (one widget, not 3-4 per source)."""
+    parts = []
+    for i, source in enumerate(sources, 1):
+        part = f"**{source.get('marker', f'[{i}]')} {source.get('source', 'Unknown')}**"
+        if source.get('section'):
+            part += f"\n\nSection: {source.get('section')}"
+        part += f"\n\n````text\n{source.get('snippet', '')}\n````"
+        parts.append(part)
+    return "\n\n---\n\n".join(parts)
+
+def handle_send(prompt: str, scope: str, fresh_answer: bool):
+    """Record the question, then answer from cache or hand the query to a worker."""
+    if not prompt.strip():
+        return
+    add_message({"role": "user", "content": prompt})
+
+    cached = None if fresh_answer else cached_answer(prompt, scope)
+    if cached:
+        add_message({
+            "role": "assistant",
+            "id": uuid.uuid4().hex,
+            "content": f"{cached['answer']}\n\n⏱️ cached",
+            "sources": cached["sources"],
+        })
+        st.rerun()
+
+    job = {"tokens": [], "trailer": {}, "error": None}
+    req = json_body({"question": prompt, "scope": scope, "stream": True})
+    st.session_state.pending = {
+        "job": job,
+        "question": prompt,
+        "scope": scope,
+        "future": get_executor().submit(_run_query_job, get_http(), req, job),
+    }
+    st.rerun()  # full rerun re-registers the fragment with a polling interval
+
+def chat_panel():
+    """
+    Transcript + composer; sending reruns only this fragment, not the sidebar/CSS.
+    While an answer is in flight the fragment polls the worker's job instead of
+    blocking the script, so the sidebar stays usable.
+    """
+    # Read per run: fragment reruns replay their call args, which would pin a stale scope
+    scope, fresh_answer = st.session_state.scope, st.session_state.fresh_answer
+    if not st.session_state.messages and not st.session_state.archived_count:
+        with st.chat_message("assistant"):
+            st.markdown("👋 Hello! Upload documents and ask questions about them.")
+
+    if st.session_state.archived_count:
+        st.button(f"⬆️ Load older ({st.session_state.archived_count})", on_click=load_older)
+
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+            if message["role"] == "assistant" and message.get("sources"):
+                # Snippet widgets are only built while the toggle is on
+                if st.toggle(f"📄 Sources ({len(message['sources'])})", key=f"src_{message.get('id', id(message))}"):
+                    st.markdown(render_sources(message["sources"]))
+
+    pending = st.session_state.pending
+    if pending:
+        partial = "".join(pending["job"]["tokens"])
+        with st.chat_message("assistant"):
+            st.markdown(f"{partial} ▌" if partial else "🤔 Thinking...")
+        if pending["future"].done():
+            _finish_pending(pending)
+            st.rerun()  # full rerun drops the polling interval
+
+    online = backend_ok()
+    if not online:
+        st.error(f"Backend unreachable at {BACKEND_URL}. Check that it is running.")
+        st.button("🔁 Retry", on_click=backend_ok.clear)
+    elif st.session_state.offline:
+        # Back online: full rerun so the fragment drops its offline re-check interval
+        st.session_state.offline = False
+        st.rerun()
+    # chat_input submits and clears itself; disabling it while an answer is in flight prevents double sends
+    if prompt := st.chat_input("Ask something about your documents...", disabled=not online or bool(pending)):
+        handle_send(prompt, scope, fresh_answer)
 
-    st.session_state.processing = False
-    scroll_to_bottom()
-    st.rerun()
+    st.markdown(f"🏷️ **Scope:** {scope}")
 
-st.markdown(f"🏷️ **Scope:** {scope}")
+# Poll every 250 ms while an answer is in flight; re-check the backend every 10 s while it is down
+st.session_state.offline = not backend_ok()
+if st.session_state.pending:
+    run_every = 0.25
+elif st.session_state.offline:
+    run_every = 10
+else:
+    run_every = None
+st.fragment(chat_panel, run_every=run_every)()
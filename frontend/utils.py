@@ -1,17 +1,33 @@
-import requests
-
 import os
+
+import httpx
+
 BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
 
+# Shared keep-alive client so repeated calls reuse the same connection
+_http = httpx.Client(
+    base_url=BACKEND_URL,
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=8, keepalive_expiry=30),
+    ),
+    timeout=httpx.Timeout(60.0, connect=2.0),
+)
+
 
-def upload_document(file_path):
+def upload_document(file_path, scope="default", fresh=False):
+    # Reserve a key, stream the raw bytes with PUT, then ask the backend to index them
+    slot = _http.post("/upload_url", json={"name": os.path.basename(file_path), "size": os.path.getsize(file_path)})
+    slot.raise_for_status()
+    slot = slot.json()
     with open(file_path, "rb") as f:
-        files = {"file": (file_path, f, "application/octet-stream")}
-        response = requests.post(f"{BACKEND_URL}/upload", files=files)
+        _http.put(slot["url"], content=f, headers={"Content-Type": "application/octet-stream"}).raise_for_status()
+    response = _http.post("/index", json={"key": slot["key"], "scope": scope, "fresh": fresh})
     response.raise_for_status()
     return response.json()
 
 def ask_question(query):
-    response = requests.post(f"{BACKEND_URL}/query", json={"question": query})
+    response = _http.post("/query", json={"question": query})
     response.raise_for_status()
     return response.json()